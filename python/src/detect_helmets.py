@@ -10,21 +10,33 @@ Outputs:
 Requirements: see requirements.txt.
 
 Usage example:
+    python detect_helmets.py --input video.mp4 --output output.mp4   # bundled weights
     python detect_helmets.py --input video.mp4 --output output.mp4 --helmet-model helmet_model.pt
     python detect_helmets.py --input 2.mp4 --output output.mp4 --helmet-model helmet_model.pt
 """
 
 import argparse
+import hashlib
 import os
+import shutil
+import queue
+import threading
 import time
 from datetime import datetime, timedelta
 import csv
 from pathlib import Path
-from collections import defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# CUDA allocator/loader defaults; must be set before torch is imported. Expandable segments stop
+# cudaMalloc/cudaFree churn as intermediate tensor sizes vary; lazy loading cuts cold-start time
+# and memory. Values already in the environment win.
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+os.environ.setdefault("CUDA_MODULE_LOADING", "LAZY")
 
 import cv2
 import numpy as np
-import pandas as pd
+import torch
 from tqdm import tqdm
 
 # Ultralytics YOLO (v8)
@@ -33,6 +45,13 @@ from ultralytics import YOLO
 # Deep SORT realtime
 from deep_sort_realtime.deepsort_tracker import DeepSort
 
+# Shared on-disk cache for downloaded model weights (and engines exported from them)
+WEIGHTS_CACHE_DIR = Path.home() / ".cache" / "ultralytics"
+# Exported TensorRT/OpenVINO models, kept out of the (possibly tracked) weights directories
+EXPORTS_DIR = WEIGHTS_CACHE_DIR / "exports"
+# Weights bundled with the repo, used by default so a run needs no network access
+MODELS_DIR = Path(__file__).resolve().parents[1] / "models" / "detection"
+
 # -----------------------
 # Helpers
 # -----------------------
@@ -42,24 +61,228 @@ def xyxy_to_xywh(box):
     h = y2 - y1
     return [int(x1), int(y1), int(w), int(h)]
 
-def iou_box(a, b):
-    # a and b are [x1,y1,x2,y2]
-    ax1, ay1, ax2, ay2 = a
-    bx1, by1, bx2, by2 = b
-    inter_x1 = max(ax1, bx1)
-    inter_y1 = max(ay1, by1)
-    inter_x2 = min(ax2, bx2)
-    inter_y2 = min(ay2, by2)
-    if inter_x2 <= inter_x1 or inter_y2 <= inter_y1:
-        return 0.0
-    inter_area = (inter_x2 - inter_x1) * (inter_y2 - inter_y1)
-    a_area = max(0, ax2 - ax1) * max(0, ay2 - ay1)
-    b_area = max(0, bx2 - bx1) * max(0, by2 - by1)
-    return inter_area / (a_area + b_area - inter_area + 1e-9)
-
-def center(box):
-    x1, y1, x2, y2 = box
-    return ((x1 + x2) / 2.0, (y1 + y2) / 2.0)
+def iou_matrix(a, b):
+    # a is (K,4) and b is (M,4) arrays of [x1,y1,x2,y2]; returns (K,M) IoU
+    inter_x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    inter_y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    inter_x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    inter_y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter_area = np.clip(inter_x2 - inter_x1, 0, None) * np.clip(inter_y2 - inter_y1, 0, None)
+    a_area = np.clip(a[:, 2] - a[:, 0], 0, None) * np.clip(a[:, 3] - a[:, 1], 0, None)
+    b_area = np.clip(b[:, 2] - b[:, 0], 0, None) * np.clip(b[:, 3] - b[:, 1], 0, None)
+    return inter_area / (a_area[:, None] + b_area[None, :] - inter_area + 1e-9)
+
+def head_match_conf(head_boxes, boxes, iou_threshold):
+    # (K,) highest confidence among the (M,5) boxes matched to each head region, 0 where none match.
+    # A box matches when its IoU with the head reaches iou_threshold or its center lies inside the head.
+    head_ious = iou_matrix(head_boxes.astype(np.float32), boxes[:, :4])
+    box_cx = (boxes[:, 0] + boxes[:, 2]) / 2.0
+    box_cy = (boxes[:, 1] + boxes[:, 3]) / 2.0
+    inside = ((head_boxes[:, None, 0] <= box_cx[None, :]) & (box_cx[None, :] <= head_boxes[:, None, 2]) &
+              (head_boxes[:, None, 1] <= box_cy[None, :]) & (box_cy[None, :] <= head_boxes[:, None, 3]))
+    matched = (head_ious >= iou_threshold) | inside
+    return np.where(matched, boxes[None, :, 4], 0.0).max(axis=1, initial=0.0)
+
+def split_helmet_classes(names):
+    # Split helmet-model class ids into (helmet, no_helmet) lists by name. Names are stripped first
+    # (the bundled model has "  Without helmet"); "without ..."/"no..." names such as "no_helmet" or
+    # "NoHelmet" are violations, any other name mentioning helmet/hardhat is a worn helmet.
+    helmet_ids, no_helmet_ids = [], []
+    for cid, name in names.items():
+        key = name.strip().lower()
+        if "helmet" not in key and "hardhat" not in key:
+            continue
+        (no_helmet_ids if key.startswith(("without", "no")) else helmet_ids).append(cid)
+    return helmet_ids, no_helmet_ids
+
+def resolve_weights(weights):
+    # Bare weight names (e.g. yolov8n.pt) that are not in the working directory resolve to a
+    # user-wide cache, so stock weights are downloaded once per machine, not once per checkout.
+    path = Path(weights)
+    if path.exists() or path.parent != Path("."):
+        return str(path)
+    return str(WEIGHTS_CACHE_DIR / path.name)
+
+def export_source(weights_path):
+    # Ultralytics writes exports and their intermediates (e.g. weights.onnx) next to the .pt, so export
+    # from a copy in EXPORTS_DIR. Named by content digest: both bundled models are called weights.pt.
+    digest = hashlib.sha1(weights_path.read_bytes()).hexdigest()[:12]
+    source = EXPORTS_DIR / f"{weights_path.stem}_{digest}.pt"
+    if not source.exists():
+        EXPORTS_DIR.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(weights_path, source)
+    return source
+
+def load_model(weights, backend="pytorch", imgsz=640, batch=1, half=False, int8=False, data=None):
+    # Load YOLO weights; with backend="tensorrt" swap in an exported engine cached in EXPORTS_DIR,
+    # keyed by weights content, input size, batch, precision, TensorRT version and GPU compute capability. backend="openvino"
+    # does the same with an OpenVINO IR directory for CPU inference. int8=True quantizes either
+    # export post-training, calibrating on the images of the `data` dataset YAML
+    # (Ultralytics' default dataset when None). Returns (model, class names); the names come from the
+    # PyTorch checkpoint, as asking an exported model for them loads the whole engine/IR a second time.
+    weights = resolve_weights(weights)
+    model = YOLO(weights)
+    names = model.names
+    if backend == "pytorch":
+        if int8:
+            print(f"INT8 needs --backend tensorrt or openvino; using FP weights for {weights}")
+        return model, names
+    if backend == "openvino":
+        weights_path = export_source(Path(model.ckpt_path or weights))
+        precision = "_int8" if int8 else ""
+        ir_path = weights_path.with_name(f"{weights_path.stem}_{imgsz}_b{batch}{precision}_openvino_model")
+        if not ir_path.exists():
+            print(f"Exporting OpenVINO model {ir_path} (one-off)...")
+            try:
+                exported = YOLO(str(weights_path)).export(format="openvino", imgsz=imgsz, batch=batch, dynamic=True,
+                                                          int8=int8, data=data, device="cpu")
+                Path(exported).replace(ir_path)
+            except Exception as e:
+                print(f"OpenVINO export failed for {weights} ({e}); using PyTorch weights")
+                return model, names
+        return YOLO(str(ir_path), task=model.task), names
+    if not torch.cuda.is_available():
+        print(f"TensorRT needs CUDA; using PyTorch weights for {weights}")
+        return model, names
+    try:
+        import tensorrt
+    except ImportError:
+        print(f"TensorRT is not installed; using PyTorch weights for {weights}")
+        return model, names
+    major, minor = torch.cuda.get_device_capability(0)
+    weights_path = export_source(Path(model.ckpt_path or weights))
+    precision = "int8" if int8 else "fp16" if half else "fp32"
+    engine_path = weights_path.with_name(
+        f"{weights_path.stem}_{imgsz}_b{batch}_{precision}_trt{tensorrt.__version__}_sm{major}{minor}.engine")
+    try:
+        if not engine_path.exists():
+            print(f"Building TensorRT engine {engine_path} (one-off)...")
+            exported = YOLO(str(weights_path)).export(format="engine", imgsz=imgsz, batch=batch, dynamic=True,
+                                                      half=half and not int8, int8=int8, data=data, device=0)
+            Path(exported).replace(engine_path)
+        engine_model = YOLO(str(engine_path), task=model.task)
+        # Ultralytics deserializes engines lazily on the first predict; do it here so an engine that
+        # does not load on this runtime falls back instead of failing inside the frame loop
+        engine_model(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), imgsz=imgsz, device=0, half=half, verbose=False)
+    except Exception as e:
+        print(f"TensorRT engine unavailable for {weights} ({e}); using PyTorch weights")
+        return model, names
+    return engine_model, names
+
+def upload_frames(frames, pinned):
+    # Stage BGR uint8 frames in the page-locked buffer and copy them to the GPU asynchronously.
+    # Returns a (B,H,W,3) uint8 CUDA tensor shared by both models.
+    host = pinned[:len(frames)]
+    host_np = host.numpy()
+    for i, frame in enumerate(frames):
+        np.copyto(host_np[i], frame)
+    return host.to("cuda", non_blocking=True)
+
+def letterbox_tensor(frames_gpu, imgsz, half, stride=32, channels_last=False):
+    # GPU equivalent of Ultralytics' letterbox: BHWC BGR uint8 -> BCHW RGB in [0,1], long side
+    # resized to imgsz and centre-padded to a stride multiple. Returns (tensor, (ratio, pad_x, pad_y)).
+    h, w = frames_gpu.shape[1:3]
+    ratio = imgsz / max(h, w)
+    new_h, new_w = round(h * ratio), round(w * ratio)
+    pad_h, pad_w = -new_h % stride, -new_w % stride
+    pad_top, pad_left = pad_h // 2, pad_w // 2
+    x = frames_gpu.permute(0, 3, 1, 2).flip(1).float()
+    x = torch.nn.functional.interpolate(x, size=(new_h, new_w), mode="bilinear", align_corners=False)
+    x = torch.nn.functional.pad(x / 255.0, (pad_left, pad_w - pad_left, pad_top, pad_h - pad_top), value=114 / 255.0)
+    x = x.half() if half else x
+    if channels_last:
+        x = x.contiguous(memory_format=torch.channels_last)
+    return x, (ratio, pad_left, pad_top)
+
+def unletterbox(data, letterbox, width, height):
+    # Map boxes.data rows (x1,y1,x2,y2,...) from letterboxed-tensor pixels back to the frame
+    if letterbox is None:
+        return data
+    ratio, pad_x, pad_y = letterbox
+    boxes = data[:, :4] - data.new_tensor([pad_x, pad_y, pad_x, pad_y])
+    boxes /= ratio
+    boxes[:, 0::2] = boxes[:, 0::2].clamp(0, width)
+    boxes[:, 1::2] = boxes[:, 1::2].clamp(0, height)
+    return torch.cat((boxes, data[:, 4:]), dim=1)
+
+def enable_channels_last(model, **kwargs):
+    # Ultralytics fuses Conv+BN when its predictor is first set up, so build the predictor with a
+    # dummy frame and then convert the fused network to NHWC weights.
+    imgsz = kwargs["imgsz"]
+    model(np.zeros((imgsz, imgsz, 3), dtype=np.uint8), **kwargs)
+    model.predictor.model.model.to(memory_format=torch.channels_last)
+
+def predict_on_stream(model, frames, stream, **kwargs):
+    # Run one YOLO call with `stream` as the current CUDA stream (None = default stream)
+    if stream is None:
+        return model(frames, **kwargs)
+    # Inputs may still be uploading on the default stream
+    stream.wait_stream(torch.cuda.default_stream())
+    with torch.cuda.stream(stream):
+        results = model(frames, **kwargs)
+    stream.synchronize()
+    return results
+
+def open_video_writer(path, fps, size, hw_encode=False):
+    # Prefer a hardware H.264 encoder (NVENC/QSV/VAAPI via OpenCV's FFmpeg backend) when asked,
+    # falling back to the software mp4v encoder if no such device is available.
+    if hw_encode:
+        writer = cv2.VideoWriter(str(path), cv2.CAP_FFMPEG, cv2.VideoWriter_fourcc(*"avc1"), fps, size,
+                                 [cv2.VIDEOWRITER_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY])
+        if writer.isOpened():
+            return writer
+        print("Hardware video encoder unavailable; falling back to software mp4v.")
+    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+    return cv2.VideoWriter(str(path), fourcc, fps, size)
+
+def advance_tracks(tracker):
+    # One constant-velocity Kalman step per track. Track.predict() would also count the frame as a
+    # miss, and DeepSORT refuses IoU matches for tracks missed more than once, so step the filter only.
+    kf = tracker.tracker.kf
+    for track in tracker.tracker.tracks:
+        track.mean, track.covariance = kf.predict(track.mean, track.covariance)
+    return tracker.tracker.tracks
+
+def average_hash(frame, size=16):
+    # 256-bit average hash: 16x16 grayscale thumbnail thresholded at its mean. An 8x8 hash is dominated
+    # by a still background and misses a rider crossing the frame.
+    thumb = cv2.cvtColor(cv2.resize(frame, (size, size), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+    return int.from_bytes(np.packbits(thumb > thumb.mean()).tobytes(), "big")
+
+def read_frames(cap, frame_queue, stop):
+    # Producer: decode frames into the queue, then a None sentinel at EOF (or once `stop` is set)
+    while not stop.is_set():
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frame_queue.put(frame)
+    frame_queue.put(None)
+
+def stop_reader(reader_thread, frame_queue, stop):
+    # Ask the producer to stop and drain its queue until it exits, so a reader blocked on a full
+    # queue cannot deadlock the join when the main loop leaves before EOF
+    stop.set()
+    while reader_thread.is_alive():
+        try:
+            frame_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    reader_thread.join()
+
+def write_frames(writer, frame_queue):
+    # Consumer: encode frames from the queue until the None sentinel
+    while True:
+        frame = frame_queue.get()
+        if frame is None:
+            break
+        writer.write(frame)
+
+def positive_int(value):
+    # argparse type for counts that must be at least 1
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be >= 1, got {value}")
+    return number
 
 # -----------------------
 # Main
@@ -71,12 +294,41 @@ def main(args):
     out_path = Path(args.output)
     csv_path = Path(args.csv)
 
+    # Inference device: first GPU when available, otherwise CPU (always CPU for OpenVINO).
+    # FP16 only pays off on CUDA, so CPU runs stay in FP32.
+    use_cuda = torch.cuda.is_available() and args.backend != "openvino"
+    device = 0 if use_cuda else "cpu"
+    half = use_cuda
+
     # Load models
-    print("Loading detection models (this may download weights if missing)...")
+    print(f"Loading detection models (missing stock weights are downloaded to {WEIGHTS_CACHE_DIR})...")
     # 1) COCO model for person + bicycle/motorcycle
-    coco_model = YOLO(args.coco_model)  # will download yolov8n.pt if not found
-    # 2) Helmet model (user-provided or downloaded)
-    helmet_model = YOLO(args.helmet_model)
+    coco_model, coco_names = load_model(args.coco_model, args.backend, args.coco_imgsz, args.batch_size, half,
+                                        args.int8, args.coco_calib_data)  # bare names like yolov8n.pt download to the cache
+    # 2) Helmet model (bundled by default, or user-provided)
+    helmet_model, helmet_names = load_model(args.helmet_model, args.backend, args.helmet_imgsz, args.batch_size,
+                                            half, args.int8, args.helmet_calib_data)
+
+    # With --concurrent-models on CUDA the two networks run concurrently: the helmet model on a worker
+    # thread, each on its own stream, so their kernels can overlap. Ultralytics calls block, hence the
+    # thread. Opt-in: it is unbenchmarked, and Ultralytics' profiler calls torch.cuda.synchronize()
+    # around each predict stage, which waits on both streams and limits the overlap.
+    if use_cuda and args.concurrent_models:
+        coco_stream, helmet_stream = torch.cuda.Stream(), torch.cuda.Stream()
+        helmet_pool = ThreadPoolExecutor(max_workers=1)
+    else:
+        coco_stream = helmet_stream = helmet_pool = None
+    # Each model gets its own inference size. Frames are letterboxed per model (by Ultralytics, or by
+    # letterbox_tensor() with --gpu-preprocess) and boxes mapped back to original-frame coordinates,
+    # so annotation still happens at full resolution.
+    coco_kwargs = dict(imgsz=args.coco_imgsz, device=device, half=half, verbose=False)
+    helmet_kwargs = dict(imgsz=args.helmet_imgsz, device=device, half=half, verbose=False)
+    # From Volta (sm70) on, cuDNN's tensor-core conv kernels prefer NHWC: keep the PyTorch networks
+    # and the GPU-letterboxed inputs (--gpu-preprocess) in channels_last. Exported backends pick their own layouts.
+    channels_last = use_cuda and args.backend == "pytorch" and torch.cuda.get_device_capability(0) >= (7, 0)
+    if channels_last:
+        enable_channels_last(coco_model, **coco_kwargs)
+        enable_channels_last(helmet_model, **helmet_kwargs)
 
     # Create tracker
     tracker = DeepSort(max_age=30,
@@ -91,192 +343,277 @@ def main(args):
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
     print(f"Video: {input_path}, {width}x{height} @ {fps:.2f} FPS, {total_frames} frames")
 
-    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-    writer = cv2.VideoWriter(str(out_path), fourcc, fps, (width, height))
+    writer = open_video_writer(out_path, fps, (width, height), hw_encode=args.hw_encode)
+
+    # With --gpu-preprocess on CUDA, frames go through one persistent page-locked buffer and a single
+    # async upload per batch, and are letterboxed on the GPU instead of by Ultralytics' per-model numpy
+    # preprocess. Opt-in: it is unbenchmarked, uploads full-resolution frames (more H2D bytes than
+    # letterboxed FP16 at 1080p), costs a host memcpy into the buffer, and Ultralytics still copies
+    # tensor inputs back to the host in postprocess.
+    pinned = None
+    if use_cuda and args.gpu_preprocess:
+        pinned = torch.empty((args.batch_size, height, width, 3), dtype=torch.uint8, pin_memory=True)
 
     # CSV prepare
     csv_fields = ["video_filename", "frame_id", "frame_timestamp_ms", "wall_clock_iso",
                   "track_id", "class", "confidence", "xmin", "ymin", "xmax", "ymax"]
-    csv_rows = []
+    # Rows are streamed to disk as they are produced; the file is only created on the first violation
+    csv_file = None
+    csv_writer = None
+    csv_row_count = 0
+
+    # Class filters, built once and kept on the inference device
+    person_cls = torch.tensor([cid for cid, name in coco_names.items() if name.lower() == "person"],
+                              dtype=torch.int32, device=device)
+    bike_cls = torch.tensor([cid for cid, name in coco_names.items()
+                             if name.lower() in ("motorcycle", "bicycle", "motorbike", "bike")],
+                            dtype=torch.int32, device=device)
+    # Helmet model classes, split into worn-helmet and explicit no-helmet ids by name.
+    # If neither is found, we'll accept all detections from helmet model as helmet-class predictions.
+    helmet_ids, no_helmet_ids = split_helmet_classes(helmet_names)
+    print(f"Helmet classes: {[helmet_names[cid] for cid in helmet_ids]}; "
+          f"no-helmet classes: {[helmet_names[cid] for cid in no_helmet_ids]}")
+    helmet_cls = torch.tensor(helmet_ids, dtype=torch.int32, device=device)
+    no_helmet_cls = torch.tensor(no_helmet_ids, dtype=torch.int32, device=device)
 
     # Track local state to avoid duplicate flood logging
-    track_last_logged_frame = defaultdict(lambda: -9999)
-    track_violation_state = defaultdict(lambda: False)
+    track_last_logged_frame = {}
+    violating_tracks = set()  # IDs currently in violation
+    last_helmet_present = {}
 
     start_wall = datetime.now()
     frame_idx = 0
 
+    # Frames are read ahead into a batch so each model runs once per batch
+    batch = deque(maxlen=args.batch_size)
+    last_hash = None
+    reused_count = 0  # consecutive near-duplicates since the last inferred frame
+
+    # Decode and encode run on their own threads (cv2 releases the GIL in read/write),
+    # so frame N+1 is decoded and frame N-1 encoded while frame N is being inferred.
+    frames_in = queue.Queue(maxsize=4)
+    frames_out = queue.Queue(maxsize=4)
+    stop_reading = threading.Event()
+    reader_thread = threading.Thread(target=read_frames, args=(cap, frames_in, stop_reading), daemon=True)
+    writer_thread = threading.Thread(target=write_frames, args=(writer, frames_out), daemon=True)
+    reader_thread.start()
+    writer_thread.start()
+
     pbar = tqdm(total=total_frames if total_frames>0 else None, desc="Processing frames")
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        frame_idx += 1
-        frame_time_ms = int((frame_idx / fps) * 1000)
-        wall_time = start_wall + timedelta(milliseconds=frame_time_ms)
-        wall_time_iso = wall_time.isoformat(sep=' ', timespec='milliseconds')
-
-        # ---------- Detect persons & bikes in this frame (COCO)
-        # Run model; get first results object
-        coco_results = coco_model(frame)[0]
-        # Each row in coco_results.boxes.data is (x1,y1,x2,y2,conf,cls)
-        boxes_data = coco_results.boxes.data.cpu().numpy() if hasattr(coco_results.boxes, "data") else coco_results.boxes.cpu().numpy()
-        persons = []
-        bikes = []
-        for row in boxes_data:
-            x1, y1, x2, y2, conf, cls = row
-            cls = int(cls)
-            cls_name = coco_model.model.names.get(cls, str(cls)) if hasattr(coco_model, "model") else str(cls)
-            if conf < args.conf:
-                continue
-            # Accept person and bike-like classes
-            if cls_name.lower() == "person":
-                persons.append((int(x1), int(y1), int(x2), int(y2), float(conf)))
-            elif cls_name.lower() in ("motorcycle", "bicycle", "motorbike", "bike"):
-                bikes.append((int(x1), int(y1), int(x2), int(y2), float(conf)))
-
-        # ---------- Detect helmets in frame (helmet_model)
-        helmet_results = helmet_model(frame)[0]
-        helmet_boxes = []
-        helmet_data = helmet_results.boxes.data.cpu().numpy() if hasattr(helmet_results.boxes, "data") else helmet_results.boxes.cpu().numpy()
-        # Helmet model class names: try to find any class name that contains 'helmet' or 'nohelmet'
-        helmet_class_ids = []
-        if hasattr(helmet_model, "model"):
-            for cid, name in helmet_model.model.names.items():
-                if "helmet" in name.lower() or "hardhat" in name.lower():
-                    helmet_class_ids.append(int(cid))
-        # If empty, we'll accept all detections from helmet model as helmet-class predictions.
-        for row in helmet_data:
-            x1, y1, x2, y2, conf, cls = row
-            cls = int(cls)
-            if conf < args.conf:
-                continue
-            if (len(helmet_class_ids) == 0) or (cls in helmet_class_ids):
-                helmet_boxes.append((int(x1), int(y1), int(x2), int(y2), float(conf)))
-
-        # ---------- Heuristic: identify riders (person close to a bike)
-        rider_candidates = []
-        for p in persons:
-            px1, py1, px2, py2, pconf = p
-            p_cx, p_cy = center((px1, py1, px2, py2))
-            is_rider = False
-            for b in bikes:
-                bx1, by1, bx2, by2, bconf = b
-                bike_w = bx2 - bx1
-                bike_h = by2 - by1
-                b_cx, b_cy = center((bx1, by1, bx2, by2))
-                dx = abs(p_cx - b_cx)
-                dy = abs(p_cy - b_cy)
-                # If bounding boxes intersect or centers are close relative to bike width/height
-                if iou_box((px1,py1,px2,py2),(bx1,by1,bx2,by2)) > 0.01 or (dx < 1.5*bike_w and dy < 1.5*bike_h):
-                    is_rider = True
-                    break
-            if is_rider:
-                rider_candidates.append(p)
-
-        # Optionally, if no bikes were found but you still want to treat all persons as riders:
-        if args.treat_all_persons_as_riders and len(rider_candidates) == 0:
-            rider_candidates = persons.copy()
-
-        # Prepare detections for tracker: format ([x,y,w,h], conf, class_name)
-        detections_for_tracker = []
-        for p in rider_candidates:
-            x1,y1,x2,y2,pconf = p
-            detections_for_tracker.append(( [int(x1), int(y1), int(x2 - x1), int(y2 - y1)], float(pconf), "person"))
-
-        # Update tracks
-        tracks = tracker.update_tracks(detections_for_tracker, frame=frame)
-
-        # For drawing and logging
-        annotated = frame.copy()
-
-        # For quick helmet lookup, build list of helmet bboxes
-        helmet_boxes_list = helmet_boxes  # (x1,y1,x2,y2,conf)
-
-        for track in tracks:
-            if not track.is_confirmed():
-                continue
-            track_id = track.track_id
-            l, t, r, b = track.to_ltrb()  # left top right bottom
-            l, t, r, b = int(l), int(t), int(r), int(b)
-            # Before:
-            # track_conf = track.det_conf if hasattr(track, "det_conf") else 1.0
-
-            # Use this instead:
-            raw_track_conf = getattr(track, "det_conf", None)
-            try:
-                track_conf = float(raw_track_conf) if raw_track_conf is not None else 0.0
-            except Exception:
-                track_conf = 0.0
-
-
-            # Define head region inside person bbox (top fraction)
-            head_h_frac = args.head_fraction  # e.g., 0.35
-            head_x1 = l
-            head_y1 = t
-            head_x2 = r
-            head_y2 = int(t + (b - t) * head_h_frac)
-            head_bbox = (head_x1, head_y1, head_x2, head_y2)
-
-            # Check if any helmet box overlaps head_bbox sufficiently
-            helmet_present = False
-            helmet_confidence_best = 0.0
-            for hb in helmet_boxes_list:
-                hx1, hy1, hx2, hy2, hconf = hb
-                ov = iou_box(head_bbox, (hx1, hy1, hx2, hy2))
-                # Also accept if helmet center lies within head bbox
-                h_cx, h_cy = center((hx1, hy1, hx2, hy2))
-                inside = (head_x1 <= h_cx <= head_x2) and (head_y1 <= h_cy <= head_y2)
-                if ov >= args.helmet_iou_threshold or inside:
-                    helmet_present = True
-                    if hconf > helmet_confidence_best:
-                        helmet_confidence_best = hconf
-
-            # Annotate
-            color = (0, 255, 0) if helmet_present else (0, 0, 255)
-            label = f"ID{track_id} {'Helmet' if helmet_present else 'NO_HELMET'}"
-            cv2.rectangle(annotated, (l, t), (r, b), color, 2)
-            cv2.rectangle(annotated, (head_x1, head_y1), (head_x2, head_y2), (255, 200, 0), 1)
-            cv2.putText(annotated, label, (l, max(t-6,10)), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
-
-            # Decide logging: if no helmet => violation
-            if not helmet_present:
-                # Log on first detection for this track, and then repeat every log_repeat_frames
-                last = track_last_logged_frame[track_id]
-                if (frame_idx - last) >= args.log_repeat_frames:
-                    # Append CSV row
-                    row = {
-                        "video_filename": input_path.name,
-                        "frame_id": frame_idx,
-                        "frame_timestamp_ms": frame_time_ms,
-                        "wall_clock_iso": wall_time_iso,
-                        "track_id": track_id,
-                        "class": "no-helmet",
-                        "confidence": float(track_conf),
-                        "xmin": int(l),
-                        "ymin": int(t),
-                        "xmax": int(r),
-                        "ymax": int(b)
-                    }
-                    csv_rows.append(row)
-                    track_last_logged_frame[track_id] = frame_idx
-                    track_violation_state[track_id] = True
+    try:
+        while True:
+            frame = frames_in.get()
+            ret = frame is not None
+            if ret:
+                batch.append(frame)
+                if len(batch) < args.batch_size:
+                    continue
+            if not batch:
+                break
+
+            frames = list(batch)
+            batch.clear()
+
+            # ---------- Decide per frame: "detect" (run YOLO), "reuse" (near-duplicate of the last inferred
+            # frame, compared by average hash) or "predict" (skipped by --detect-stride, tracker-only)
+            modes = []
+            for idx, frame in enumerate(frames, start=frame_idx + 1):
+                if (idx - 1) % args.detect_stride != 0:
+                    modes.append("predict")
+                    continue
+                if args.dedup_threshold >= 0:
+                    # At most --dedup-max-reuse frames in a row reuse detections, so slow-moving riders
+                    # on a static background cannot freeze them
+                    frame_hash = average_hash(frame)
+                    if (last_hash is not None and reused_count < args.dedup_max_reuse and
+                            (frame_hash ^ last_hash).bit_count() <= args.dedup_threshold):
+                        reused_count += 1
+                        modes.append("reuse")
+                        continue
+                    last_hash = frame_hash
+                    reused_count = 0
+                modes.append("detect")
+            infer_frames = [frame for frame, mode in zip(frames, modes) if mode == "detect"]
+
+            # ---------- Batched inference (one call per model for the whole batch)
+            coco_letterbox = helmet_letterbox = None
+            if not infer_frames:
+                coco_batch = helmet_batch = []
             else:
-                track_violation_state[track_id] = False
-
-        # Write annotated frame to output
-        writer.write(annotated)
-        pbar.update(1)
-
-    pbar.close()
-    cap.release()
-    writer.release()
-
-    # Save CSV
-    if len(csv_rows) > 0:
-        df = pd.DataFrame(csv_rows, columns=csv_fields)
-        df.to_csv(csv_path, index=False)
-        print(f"Saved violations CSV to: {csv_path} ({len(df)} rows)")
+                coco_input = helmet_input = infer_frames
+                if pinned is not None:
+                    frames_gpu = upload_frames(infer_frames, pinned)
+                    coco_input, coco_letterbox = letterbox_tensor(frames_gpu, args.coco_imgsz, half, channels_last=channels_last)
+                    helmet_input, helmet_letterbox = letterbox_tensor(frames_gpu, args.helmet_imgsz, half, channels_last=channels_last)
+                if helmet_pool is not None:
+                    helmet_future = helmet_pool.submit(predict_on_stream, helmet_model, helmet_input, helmet_stream, **helmet_kwargs)
+                    coco_batch = predict_on_stream(coco_model, coco_input, coco_stream, **coco_kwargs)
+                    helmet_batch = helmet_future.result()
+                else:
+                    coco_batch = coco_model(coco_input, **coco_kwargs)
+                    helmet_batch = helmet_model(helmet_input, **helmet_kwargs)
+            batch_results = zip(coco_batch, helmet_batch)
+
+            for frame, mode in zip(frames, modes):
+                frame_idx += 1
+                frame_time_ms = int((frame_idx / fps) * 1000)
+                wall_time = start_wall + timedelta(milliseconds=frame_time_ms)
+                wall_time_iso = wall_time.isoformat(sep=' ', timespec='milliseconds')
+
+                if mode == "predict":
+                    # Stride-skipped frame: only advance the tracker's Kalman filters (constant velocity)
+                    tracks = advance_tracks(tracker)
+                else:
+                    # Near-duplicates reuse rider_candidates/helmet_boxes/no_helmet_boxes from the last inferred frame
+                    if mode == "detect":
+                        coco_results, helmet_results = next(batch_results)
+
+                        # ---------- Detect persons & bikes in this frame (COCO)
+                        # Each row in coco_results.boxes.data is (x1,y1,x2,y2,conf,cls). Filter on-device and
+                        # only copy the surviving rows to the host, tagging each one as person (1) or bike (0).
+                        coco_data = unletterbox(coco_results.boxes.data, coco_letterbox, width, height)
+                        coco_cls = coco_data[:, 5].int()
+                        coco_is_person = torch.isin(coco_cls, person_cls)
+                        coco_keep = (coco_data[:, 4] >= args.conf) & (coco_is_person | torch.isin(coco_cls, bike_cls))
+                        coco_rows = torch.cat((coco_data[:, :5], coco_is_person[:, None].to(coco_data.dtype)), dim=1)
+                        coco_rows = coco_rows[coco_keep].float().cpu().numpy()
+                        # Rows are (x1,y1,x2,y2,conf) float32
+                        persons = coco_rows[coco_rows[:, 5] > 0, :5]
+                        bikes = coco_rows[coco_rows[:, 5] == 0, :5]
+
+                        # ---------- Detect helmets in frame (helmet_model)
+                        # Same on-device filter as above, tagging each kept row as no-helmet (1) or helmet (0)
+                        helmet_data = unletterbox(helmet_results.boxes.data, helmet_letterbox, width, height)
+                        helmet_cls_ids = helmet_data[:, 5].int()
+                        helmet_is_none = torch.isin(helmet_cls_ids, no_helmet_cls)
+                        helmet_keep = helmet_data[:, 4] >= args.conf
+                        if len(helmet_cls) + len(no_helmet_cls) > 0:
+                            helmet_keep &= helmet_is_none | torch.isin(helmet_cls_ids, helmet_cls)
+                        helmet_rows = torch.cat((helmet_data[:, :5], helmet_is_none[:, None].to(helmet_data.dtype)), dim=1)
+                        helmet_rows = helmet_rows[helmet_keep].float().cpu().numpy()
+                        # Rows are (x1,y1,x2,y2,conf) float32
+                        helmet_boxes = helmet_rows[helmet_rows[:, 5] == 0, :5]
+                        no_helmet_boxes = helmet_rows[helmet_rows[:, 5] > 0, :5]
+
+                        # ---------- Heuristic: identify riders (person close to a bike)
+                        # Every person vs every bike: boxes intersect, or centers are close relative to bike width/height
+                        rider_iou = iou_matrix(persons[:, :4], bikes[:, :4])
+                        person_centers = (persons[:, :2] + persons[:, 2:4]) / 2.0
+                        bike_centers = (bikes[:, :2] + bikes[:, 2:4]) / 2.0
+                        bike_w = bikes[:, 2] - bikes[:, 0]
+                        bike_h = bikes[:, 3] - bikes[:, 1]
+                        dx = np.abs(person_centers[:, None, 0] - bike_centers[None, :, 0])
+                        dy = np.abs(person_centers[:, None, 1] - bike_centers[None, :, 1])
+                        close = (dx < 1.5 * bike_w[None, :]) & (dy < 1.5 * bike_h[None, :])
+                        rider_mask = ((rider_iou > 0.01) | close).any(axis=1)
+                        rider_candidates = persons[rider_mask]
+
+                        # Optionally, if no bikes were found but you still want to treat all persons as riders:
+                        if args.treat_all_persons_as_riders and len(rider_candidates) == 0:
+                            rider_candidates = persons
+
+                    # Prepare detections for tracker: format ([x,y,w,h], conf, class_name)
+                    detections_for_tracker = []
+                    for x1, y1, x2, y2, pconf in rider_candidates.tolist():
+                        x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
+                        detections_for_tracker.append(( [x1, y1, x2 - x1, y2 - y1], pconf, "person"))
+
+                    # Update tracks
+                    tracks = tracker.update_tracks(detections_for_tracker, frame=frame)
+
+                # For drawing and logging. Drawn in place: inference and tracking are done with this frame,
+                # and the reader thread hands out a fresh buffer per cap.read().
+                annotated = frame
+
+                # Head region of every confirmed track vs every helmet box, in one shot
+                confirmed = [track for track in tracks if track.is_confirmed()]
+                track_boxes = np.array([track.to_ltrb() for track in confirmed], dtype=np.float64).reshape(-1, 4).astype(np.int32)
+                # Define head region inside person bbox (top fraction)
+                head_boxes = track_boxes.copy()
+                head_boxes[:, 3] = (track_boxes[:, 1] + (track_boxes[:, 3] - track_boxes[:, 1]) * args.head_fraction).astype(np.int32)
+                if mode == "predict":
+                    # No fresh helmet boxes: carry over each track's last helmet decision
+                    helmet_matches = [last_helmet_present.get(track.track_id, False) for track in confirmed]
+                else:
+                    # A head counts as helmeted when its best helmet match beats its best no-helmet match,
+                    # so an explicit no-helmet box on the head always logs a violation unless outscored
+                    helmet_conf = head_match_conf(head_boxes, helmet_boxes, args.helmet_iou_threshold)
+                    no_helmet_conf = head_match_conf(head_boxes, no_helmet_boxes, args.helmet_iou_threshold)
+                    helmet_matches = (helmet_conf > no_helmet_conf).tolist()
+
+                for track, (l, t, r, b), (head_x1, head_y1, head_x2, head_y2), helmet_present in zip(
+                        confirmed, track_boxes.tolist(), head_boxes.tolist(), helmet_matches):
+                    track_id = track.track_id
+                    last_helmet_present[track_id] = helmet_present
+                    # Before:
+                    # track_conf = track.det_conf if hasattr(track, "det_conf") else 1.0
+
+                    # Use this instead:
+                    raw_track_conf = getattr(track, "det_conf", None)
+                    try:
+                        track_conf = float(raw_track_conf) if raw_track_conf is not None else 0.0
+                    except Exception:
+                        track_conf = 0.0
+
+                    # Annotate
+                    color = (0, 255, 0) if helmet_present else (0, 0, 255)
+                    label = f"ID{track_id} {'Helmet' if helmet_present else 'NO_HELMET'}"
+                    cv2.rectangle(annotated, (l, t), (r, b), color, 2)
+                    cv2.rectangle(annotated, (head_x1, head_y1), (head_x2, head_y2), (255, 200, 0), 1)
+                    cv2.putText(annotated, label, (l, max(t-6,10)), cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+
+                    # Decide logging: if no helmet => violation
+                    if not helmet_present:
+                        # Log on first detection for this track, and then repeat every log_repeat_frames
+                        last = track_last_logged_frame.get(track_id, -9999)
+                        if (frame_idx - last) >= args.log_repeat_frames:
+                            # Append CSV row
+                            row = {
+                                "video_filename": input_path.name,
+                                "frame_id": frame_idx,
+                                "frame_timestamp_ms": frame_time_ms,
+                                "wall_clock_iso": wall_time_iso,
+                                "track_id": track_id,
+                                "class": "no-helmet",
+                                "confidence": float(track_conf),
+                                "xmin": int(l),
+                                "ymin": int(t),
+                                "xmax": int(r),
+                                "ymax": int(b)
+                            }
+                            if csv_writer is None:
+                                csv_file = open(csv_path, "w", newline="", buffering=1 << 20)
+                                csv_writer = csv.DictWriter(csv_file, fieldnames=csv_fields, lineterminator="\n")
+                                csv_writer.writeheader()
+                            csv_writer.writerow(row)
+                            csv_row_count += 1
+                            track_last_logged_frame[track_id] = frame_idx
+                            violating_tracks.add(track_id)
+                    else:
+                        violating_tracks.discard(track_id)
+
+                # Write annotated frame to output
+                frames_out.put(annotated)
+                pbar.update(1)
+
+            if not ret:
+                break
+
+    finally:
+        # Also on errors and Ctrl-C: flush buffered CSV rows and finalise the MP4
+        pbar.close()
+        if helmet_pool is not None:
+            helmet_pool.shutdown()
+        frames_out.put(None)
+        stop_reader(reader_thread, frames_in, stop_reading)
+        writer_thread.join()
+        cap.release()
+        writer.release()
+        if csv_file is not None:
+            csv_file.close()
+
+    if csv_file is not None:
+        print(f"Saved violations CSV to: {csv_path} ({csv_row_count} rows)")
     else:
         print("No violations logged; CSV not created.")
     print(f"Annotated video saved to: {out_path}")
@@ -284,15 +621,53 @@ def main(args):
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Helmet detection + tracking for uploaded MP4.")
+    parser = argparse.ArgumentParser(
+        description="Helmet detection + tracking for uploaded MP4.",
+        epilog="CUDA defaults: PYTORCH_CUDA_ALLOC_CONF=expandable_segments:True and CUDA_MODULE_LOADING=LAZY "
+               "are set unless already present in the environment.")
     parser.add_argument("--input", required=True, help="Input .mp4 video path")
     parser.add_argument("--output", default="output.mp4", help="Path to annotated output MP4")
     parser.add_argument("--csv", default="violations.csv", help="Path to output CSV")
-    parser.add_argument("--helmet-model", default="helmet_model.pt", help="YOLOv8 helmet model weights (pt)")
-    parser.add_argument("--coco-model", default="yolov8n.pt", help="General COCO YOLOv8 model for person+bike detection")
+    parser.add_argument("--helmet-model", default=str(MODELS_DIR / "custom_helmet" / "weights.pt"),
+                        help="YOLOv8 helmet model weights (pt); defaults to the bundled custom_helmet weights "
+                             "(classes 'With helmet' / 'Without helmet'). Classes named 'without ...'/'no...' "
+                             "count as violations")
+    parser.add_argument("--coco-model", default=str(MODELS_DIR / "yolov8n" / "weights.pt"),
+                        help="General COCO YOLOv8 model for person+bike detection; defaults to the bundled yolov8n "
+                             "weights (a bare name like yolov8n.pt is downloaded to the cache instead)")
+    parser.add_argument("--backend", choices=("pytorch", "tensorrt", "openvino"), default="pytorch",
+                        help=f"Inference backend; 'tensorrt' builds and caches .engine files in {EXPORTS_DIR} (CUDA only), "
+                             f"'openvino' exports and caches an OpenVINO model there and runs it on the CPU")
+    parser.add_argument("--int8", action="store_true",
+                        help="Quantize the exported tensorrt/openvino models to INT8 (post-training; cached separately)")
+    parser.add_argument("--coco-calib-data", default=None,
+                        help="Dataset YAML whose images calibrate the INT8 COCO model (default: Ultralytics' coco8.yaml)")
+    parser.add_argument("--helmet-calib-data", default=None,
+                        help="Dataset YAML whose images calibrate the INT8 helmet model; use a few hundred frames "
+                             "from the target cameras (default: Ultralytics' coco8.yaml)")
+    parser.add_argument("--coco-imgsz", type=int, default=640, help="Inference size for the COCO model (default 640)")
+    parser.add_argument("--helmet-imgsz", type=int, default=640,
+                        help="Inference size for the helmet model; raise (e.g. 832) for small or distant heads")
     parser.add_argument("--conf", type=float, default=0.4, help="Detection confidence threshold (default 0.4)")
     parser.add_argument("--helmet-iou-threshold", type=float, default=0.1, help="IOU threshold to match helmet to head region")
     parser.add_argument("--head-fraction", type=float, default=0.35, help="Top fraction of person bbox considered head region")
+    parser.add_argument("--batch-size", type=positive_int, default=8, help="Number of frames sent to each YOLO model per inference call")
+    parser.add_argument("--hw-encode", action="store_true",
+                        help="Encode the output with a hardware H.264 encoder if available (falls back to mp4v)")
+    parser.add_argument("--concurrent-models", action="store_true",
+                        help="On CUDA, run the COCO and helmet models concurrently on separate streams "
+                             "(experimental; benchmark before use)")
+    parser.add_argument("--gpu-preprocess", action="store_true",
+                        help="On CUDA, upload frames through a pinned buffer and letterbox them on the GPU "
+                             "instead of in Ultralytics' CPU preprocess (experimental; benchmark before use)")
+    parser.add_argument("--detect-stride", type=positive_int, default=2,
+                        help="Run detection every Nth frame; in between, tracks are advanced by the Kalman filter "
+                             "and keep their last helmet decision (1 = detect on every frame)")
+    parser.add_argument("--dedup-threshold", type=int, default=-1,
+                        help="Reuse the previous detections when a frame's 256-bit average hash is within this "
+                             "Hamming distance of the last inferred frame, e.g. 2 (default -1 = disabled)")
+    parser.add_argument("--dedup-max-reuse", type=positive_int, default=4,
+                        help="Force a fresh detection after this many consecutive reused frames (default 4)")
     parser.add_argument("--log-repeat-frames", type=int, default=30, help="How many frames between repeated logs for same track")
     parser.add_argument("--treat-all-persons-as-riders", action="store_true",
                         help="If set, treat all detected persons as riders (useful if bike detection fails)")